@@ -1,17 +1,30 @@
 import os
 import json
-import random
 import logging
 import uuid
 import re
 import io
 import datetime
+import hashlib
+import tempfile
+import threading
+import time
+import multiprocessing
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
+import xlsxwriter
+from python_calamine import CalamineWorkbook
 import click
-from functools import wraps
-from flask import Flask, request, render_template, send_file, jsonify, session, redirect, url_for, send_from_directory
+from functools import wraps, lru_cache
+from flask import Flask, request, render_template, send_file, jsonify, session, redirect, url_for, send_from_directory, abort
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.utils import safe_join
+from werkzeug.middleware.proxy_fix import ProxyFix
 from urllib.parse import quote
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import timedelta
 
 app = Flask(__name__)
@@ -21,19 +34,28 @@ app.secret_key = os.environ.get("FLASK_SECRET_KEY", os.urandom(24))
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=30)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['RESULT_FOLDER'] = 'results'
+# 结果下载交给前置服务器零拷贝发送: USE_X_SENDFILE=1 (Apache/lighttpd) 或 X_ACCEL_PREFIX=/internal-results/ (nginx)
+app.use_x_sendfile = os.environ.get("USE_X_SENDFILE") == "1"
+app.config['X_ACCEL_PREFIX'] = os.environ.get("X_ACCEL_PREFIX")
+# 前置反向代理的层数: 设置后从 X-Forwarded-For 取真实客户端 IP (登录限流按此区分客户端)
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", "0"))
+if TRUSTED_PROXIES: app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+# 拆分工具整表解析 (_load_workbook) 使用的 pandas 引擎: 默认 calamine (xls/xlsx 通用)；设为 openpyxl 等时 .xls 回退到 xlrd。
+# 表头读取与比对工具的逐行读取固定使用 calamine / openpyxl 只读模式，不受此项影响
+XLSX_ENGINE = os.environ.get("XLSX_ENGINE", "calamine")
 AUTH_FILE = 'auth.json'
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['RESULT_FOLDER'], exist_ok=True)
 
 # --- 日志配置 (修复日志循环问题) ---
-log_stream = []
+# 限制缓冲区大小，防止内存溢出: deque 满后自动 O(1) 丢弃最旧的日志
+log_stream = deque(maxlen=1000)
+log_lock = threading.Lock()
 class WebLogHandler(logging.Handler):
     def emit(self, record):
         log_entry = self.format(record)
-        log_stream.append(log_entry)
-        # 限制缓冲区大小，防止内存溢出
-        if len(log_stream) > 1000: log_stream.pop(0)
+        with log_lock: log_stream.append(log_entry)
 
 logger = logging.getLogger('web_logger')
 logger.setLevel(logging.INFO)
@@ -43,35 +65,82 @@ handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)
 logger.addHandler(handler)
 
 # --- 认证逻辑 ---
+# auth.json 按 mtime 缓存，每个请求只需一次 stat 而不是 open + json.load
+_AUTH_CACHE = {"mtime": 0, "data": None}
+_AUTH_LOCK = threading.Lock()
+
+# 返回缓存的副本: 调用方 (add/del) 修改后写盘失败也不会污染缓存，其他线程读到的始终是完整快照
 def load_auth_db():
     default_db = {"users": {}}
-    if not os.path.exists(AUTH_FILE): return default_db
-    try:
-        with open(AUTH_FILE, 'r') as f:
-            data = json.load(f)
-            if "username" in data: 
-                new_db = {"users": {data["username"]: data["password_hash"]}}
-                save_auth_db(new_db)
-                return new_db
-            return data
-    except: return default_db
-
+    try: mtime = os.stat(AUTH_FILE).st_mtime_ns
+    except OSError: return default_db
+    with _AUTH_LOCK:
+        if _AUTH_CACHE["data"] is None or _AUTH_CACHE["mtime"] != mtime:
+            try:
+                with open(AUTH_FILE, 'r') as f:
+                    data = json.load(f)
+                if "username" in data: 
+                    data = {"users": {data["username"]: data["password_hash"]}}
+                    save_auth_db(data)
+                    mtime = os.stat(AUTH_FILE).st_mtime_ns
+                _AUTH_CACHE.update(mtime=mtime, data=data)
+            except:  # 读取失败时沿用上一次成功解析的结果
+                if _AUTH_CACHE["data"] is None: return default_db
+        return {"users": dict(_AUTH_CACHE["data"]["users"])}
+
+# 先写临时文件再原子替换: 并发请求按 mtime 重新加载时不会读到写了一半的 JSON
 def save_auth_db(data):
-    with open(AUTH_FILE, 'w') as f: json.dump(data, f)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(AUTH_FILE)), suffix='.part')
+    with os.fdopen(fd, 'w') as f: json.dump(data, f)
+    os.replace(tmp, AUTH_FILE)
 
 def add_user_logic(username, password):
     db = load_auth_db()
     db["users"][username] = generate_password_hash(password)
     save_auth_db(db)
+    _verified.clear()
 
 def del_user_logic(username):
     db = load_auth_db()
     if username in db["users"]:
         del db["users"][username]
         save_auth_db(db)
+        _verified.clear()
         return True
     return False
 
+# PBKDF2 校验本身刻意很慢: 校验成功的 (哈希, 密码摘要) 直接复用结果。
+# 只缓存成功的组合，且只保存进程内随机密钥的 HMAC 摘要，不在内存中保留明文密码
+_VERIFY_KEY = os.urandom(32)
+_verified = set()
+
+def _verify(user_hash, password):
+    token = (user_hash, hashlib.blake2b(password.encode(), key=_VERIFY_KEY).digest())
+    if token in _verified: return True
+    if not check_password_hash(user_hash, password): return False
+    if len(_verified) >= 256: _verified.clear()
+    _verified.add(token)
+    return True
+
+# 登录限流: 每个客户端 IP 一个令牌桶，超限的请求在哈希之前直接拒绝。
+# 部署在反向代理之后时需设置 TRUSTED_PROXIES，否则所有用户共用代理的 IP 与同一个令牌桶
+LOGIN_BUCKET_SIZE = 10
+LOGIN_REFILL_PER_SEC = 10 / 60
+_login_buckets = {}
+_LOGIN_LOCK = threading.Lock()
+
+def take_login_token(ip):
+    now = time.monotonic()
+    with _LOGIN_LOCK:
+        if len(_login_buckets) > 4096:
+            for k in [k for k, (_, last) in _login_buckets.items() if now - last > LOGIN_BUCKET_SIZE / LOGIN_REFILL_PER_SEC]:
+                del _login_buckets[k]
+        tokens, last = _login_buckets.get(ip, (LOGIN_BUCKET_SIZE, now))
+        tokens = min(LOGIN_BUCKET_SIZE, tokens + (now - last) * LOGIN_REFILL_PER_SEC)
+        allowed = tokens >= 1
+        _login_buckets[ip] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
 # --- CLI Commands ---
 @app.cli.command("add-user")
 @click.argument("username")
@@ -118,9 +187,11 @@ def setup():
 def login():
     error = None
     if request.method == 'POST':
-        u, p = request.form.get('username'), request.form.get('password')
+        if not take_login_token(request.remote_addr):
+            return render_template('login.html', error="尝试次数过多，请稍后再试"), 429
+        u, p = request.form.get('username'), request.form.get('password') or ''
         db = load_auth_db()
-        if u in db["users"] and check_password_hash(db["users"][u], p):
+        if u in db["users"] and _verify(db["users"][u], p):
             session['logged_in'] = True
             session['user'] = u
             return redirect(url_for('portal'))
@@ -135,173 +206,387 @@ def logout():
 @app.route('/')
 def portal(): return render_template('portal.html')
 
+XLSX_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+def send_result(filename):
+    prefix = app.config['X_ACCEL_PREFIX']
+    if not prefix: return send_from_directory(app.config['RESULT_FOLDER'], filename, as_attachment=True)
+    path = safe_join(app.config['RESULT_FOLDER'], filename)
+    if path is None or not os.path.isfile(path): abort(404)
+    # 只返回响应头，由 nginx 的 internal location 直接 sendfile 结果文件
+    resp = app.response_class(mimetype=XLSX_MIME)
+    resp.headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(filename)
+    resp.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(filename)}"
+    return resp
+
+# 处理接口带 ?stream=1 时结果在内存中生成并直接作为附件返回，省去落盘和第二次下载请求；
+# 否则写入结果目录并返回文件名，由前端再走 download 接口 (两步流程)
+def finish_result(write, filename):
+    if request.args.get('stream') == '1':
+        buf = io.BytesIO()
+        write(buf)
+        buf.seek(0)
+        return send_file(buf, as_attachment=True, download_name=filename, mimetype=XLSX_MIME)
+    write(os.path.join(app.config['RESULT_FOLDER'], filename))
+    return jsonify({"success": True, "filename": filename})
+
 # --- 拆分模块 ---
 @app.route('/tool/splitter')
 def splitter_ui(): return render_template('splitter.html')
 
-def split_smart_algo(total_qty, days, is_int):
-    if days <= 1: return [total_qty]
-    amounts = []
-    if is_int:
-        total_int = int(total_qty)
-        if total_int < days: return [1] * total_int
-        base = total_int // days
-        remainder = total_int % days
-        amounts = [base] * days
-        indices = list(range(days))
-        random.shuffle(indices)
-        for i in range(remainder): amounts[indices[i]] += 1
-    else:
-        weights = [random.uniform(0.8, 1.2) for _ in range(days)]
-        sum_weights = sum(weights)
-        curr = 0
-        for w in weights[:-1]:
-            val = round((w / sum_weights) * total_qty, 1)
-            if val == 0 and total_qty > 1: val = 0.1
-            amounts.append(val)
-            curr += val
-        amounts.append(round(total_qty - curr, 1))
-    return amounts
+# 批量拆分: 所有行一次完成，返回 (n, K) 拆分矩阵与每行实际拆分份数 counts (每行只有前 counts 列有效)
+# 小数: 在各行前 active 列生成 0.8~1.2 随机权重，归一化后保留 1 位小数，最后一份承接舍入误差
+# 整数: 平均分配后把余数随机撒到 active 份中的若干份；数量不足 active 时拆成若干个 1
+# active 为 1 的行 (含整数单位) 保留原数量不拆
+def split_batch_algo(qty_arr, active_arr, is_int_arr, rng):
+    n = len(qty_arr)
+    K = int(active_arr.max(initial=1))
+    rows = np.arange(n)
+    last = active_arr - 1
+    in_range = np.arange(K)[None, :] < active_arr[:, None]
+
+    weights = rng.uniform(0.8, 1.2, (n, K)) * in_range
+    splits = np.round(weights / weights.sum(axis=1, keepdims=True) * qty_arr[:, None], 1)
+    splits[(splits == 0) & (qty_arr[:, None] > 1)] = 0.1
+    splits[~in_range] = 0
+    splits[rows, last] = 0
+    splits[rows, last] = np.round(qty_arr - splits.sum(axis=1), 1)
+
+    total_int = np.floor(qty_arr)
+    base, remainder = total_int // active_arr, total_int % active_arr
+    rank = np.where(in_range, rng.random((n, K)), np.inf).argsort(axis=1).argsort(axis=1)
+    int_splits = np.where(total_int[:, None] < active_arr[:, None], 1.0, base[:, None] + (rank < remainder[:, None]))
+    splits = np.where(is_int_arr[:, None], int_splits, splits)
+
+    counts = np.where(is_int_arr & (total_int < active_arr), total_int, active_arr).astype(np.int64)
+    single = active_arr <= 1
+    splits[single, 0] = qty_arr[single]
+    counts[single] = 1
+    return splits, counts
+
+# 与 pandas 读表头的规则一致: 空表头命名为 "Unnamed: i"，重复列名依次加 .1/.2 后缀 (跳过表中已有的名称)，
+# 保证每列可单独选中
+def header_names(row):
+    names = [c if c not in (None, '') else f"Unnamed: {i}" for i, c in enumerate(row)]
+    original = set(names)
+    unnamed = [i for i, c in enumerate(row) if c in (None, '')]
+    counts = {}
+    for i in [i for i in range(len(names)) if row[i] not in (None, '')] + unnamed:
+        base = name = names[i]
+        n = counts.get(name, 0)
+        while n > 0:
+            counts[base] = n + 1
+            name = f"{base}.{n}"
+            n = n + 1 if name in original else counts.get(name, 0)
+        names[i] = name
+        counts[name] = n + 1
+    return names
+
+MAX_UNIT_OPTIONS = 500
+
+# --- 上传缓存: 同一文件只解析一次 (拆分的 analyze / sheet_info / process，以及比对任务的重复执行) ---
+# 进程内 lru_cache 之外，解析结果另存为 pickle，进程重启或多 worker 时仍可直接复用
+UPLOAD_TTL = 24 * 3600
+_CACHE_FILE_RE = re.compile(r'[0-9a-f]{128}(\.xlsx|_[0-9a-f]{16}\.pkl)|.*\.part')
+
+def upload_path(key): return os.path.join(app.config['UPLOAD_FOLDER'], f"{key}.xlsx")
+
+def sheet_cache_path(key, sheet_name):
+    tag = hashlib.blake2b(repr(sheet_name).encode(), digest_size=8).hexdigest()
+    return os.path.join(app.config['UPLOAD_FOLDER'], f"{key}_{tag}.pkl")
+
+# 上传文件统一以 .xlsx 缓存，只能按文件头判断是否为 OLE2 格式的 .xls
+def read_engine(f):
+    if XLSX_ENGINE == 'calamine': return XLSX_ENGINE
+    head = f.read(8)
+    f.seek(0)
+    return 'xlrd' if head == b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1' else XLSX_ENGINE
+
+@lru_cache(maxsize=8)
+def _load_workbook(key, sheet_name):
+    cached = sheet_cache_path(key, sheet_name)
+    if os.path.exists(cached): return pd.read_pickle(cached)
+    with open(upload_path(key), 'rb') as f:
+        df = pd.read_excel(f, sheet_name=sheet_name, engine=read_engine(f))
+    save_cache(df, cached)
+    return df
+
+# 先写临时文件再原子替换，并发请求不会读到写了一半的缓存
+def save_cache(obj, path):
+    fd, tmp = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'], suffix='.part')
+    with os.fdopen(fd, 'wb') as out: pd.to_pickle(obj, out)
+    os.replace(tmp, path)
+
+def cleanup_uploads():
+    cutoff = time.time() - UPLOAD_TTL
+    for entry in os.scandir(app.config['UPLOAD_FOLDER']):
+        if _CACHE_FILE_RE.fullmatch(entry.name) and entry.stat().st_mtime < cutoff:
+            try: os.remove(entry.path)
+            except OSError: pass
+
+# 边读边写入磁盘并计算哈希，上传内容不在内存中整体驻留
+def save_upload(file):
+    h = hashlib.blake2b()
+    fd, tmp = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'], suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in iter(lambda: file.stream.read(1 << 20), b''):
+                h.update(chunk)
+                out.write(chunk)
+    except:
+        os.remove(tmp)
+        raise
+    key = h.hexdigest()
+    os.replace(tmp, upload_path(key))
+    cleanup_uploads()
+    return key
+
+def resolve_upload_key():
+    key = request.form.get('file_key') or session.get('split_key')
+    if not key or not re.fullmatch(r'[0-9a-f]{128}', key) or not os.path.exists(upload_path(key)):
+        return None
+    return key
 
 @app.route('/api/splitter/analyze', methods=['POST'])
 def splitter_analyze():
     file = request.files.get('file')
     if not file: return jsonify({"error": "未找到文件"}), 400
     try:
-        content = file.read()
-        f_bytes = io.BytesIO(content)
-        visible = []
+        key = save_upload(file)
+        session['split_key'] = key
         if file.filename.lower().endswith('.xlsx'):
-            try:
-                from openpyxl import load_workbook
-                wb = load_workbook(f_bytes, read_only=True)
-                visible = [s.title for s in wb.worksheets if s.sheet_state == 'visible']
+            # 只读模式一次遍历: 同时拿到可见工作表与首行表头，不再整本解析
+            from openpyxl import load_workbook
+            wb = load_workbook(upload_path(key), read_only=True)
+            sheets = [s.title for s in wb.worksheets if s.sheet_state == 'visible'] or wb.sheetnames
+            header = next(wb[sheets[0]].iter_rows(max_row=1, values_only=True), ())
+            wb.close()
+        else:
+            with open(upload_path(key), 'rb') as f:
+                wb = CalamineWorkbook.from_filelike(f)
+                sheets = wb.sheet_names
+                # 与 read_excel 相同，不跳过表头前的空行
+                header = next(wb.get_sheet_by_name(sheets[0]).iter_rows(), [])
                 wb.close()
-            except: pass
-        f_bytes.seek(0)
-        xl = pd.ExcelFile(f_bytes)
-        sheets = [s for s in xl.sheet_names if s in visible] if visible else xl.sheet_names
-        if not sheets: sheets = xl.sheet_names
-        df = xl.parse(sheets[0], nrows=10)
-        return jsonify({"sheets": sheets, "columns": df.columns.tolist()})
+        return jsonify({"sheets": sheets, "columns": header_names(header), "file_key": key})
     except Exception as e: return jsonify({"error": str(e)}), 500
 
 @app.route('/api/splitter/sheet_info', methods=['POST'])
 def splitter_sheet_info():
-    file = request.files.get('file')
+    key = resolve_upload_key()
+    if not key: return jsonify({"error": "文件已失效，请重新上传"}), 400
     try:
-        df = pd.read_excel(file, sheet_name=request.form.get('sheet_name'))
+        df = _load_workbook(key, request.form.get('sheet_name'))
         unit_col = next((c for c in df.columns if '单位' in str(c)), None)
-        units = df[unit_col].dropna().unique().tolist() if unit_col else []
+        # 单位选项只取前 MAX_UNIT_OPTIONS 个，误选到编号类列时不会返回成千上万个复选框
+        units = df[unit_col].dropna().unique()[:MAX_UNIT_OPTIONS].tolist() if unit_col else []
         return jsonify({"columns": df.columns.tolist(), "units": [str(u) for u in units]})
     except Exception as e: return jsonify({"error": str(e)}), 500
 
+# xlsxwriter constant_memory 模式逐行落盘，内存中只保留当前行。
+# pandas 的 to_excel 按列写单元格，与该模式不兼容 (会丢数据)，所以这里按行直接写。
+# strings_to_urls=False: 以 http:// 等开头的文本按普通文本写入，不转超链接 (超长或过多的链接会被丢弃)
+def write_sheets_streaming(path, header, sheets):
+    wb = xlsxwriter.Workbook(path, {'constant_memory': True, 'strings_to_urls': False, 'default_date_format': 'yyyy-mm-dd hh:mm:ss'})
+    header_fmt = wb.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    for sheet_name, rows in sheets:
+        ws = wb.add_worksheet(sheet_name)
+        ws.write_row(0, 0, [str(c) for c in header], header_fmt)
+        for r, row in enumerate(rows, start=1):
+            ws.write_row(r, 0, row)
+    wb.close()
+
+# 列名含以下关键字 (或为单价列) 的列原样复制，不随拆分比例缩放
+STATIC_COL_KEYWORDS = ('id', 'code', 'date', '日期', '单价', '价', '规格')
+
+# 保留列分类: qty 拆分数量 / amt 数量×单价 / copy 原样复制 / scale 纯数值缩放 / mixed 混合列只缩放数值单元格
+def split_col_kind(col, series, col_a, col_b, col_c, has_price):
+    if col == col_a: return 'qty'
+    if col == col_c and has_price: return 'amt'
+    if col == col_b or any(k in str(col).lower() for k in STATIC_COL_KEYWORDS): return 'copy'
+    return 'scale' if series.dtype.kind in 'iuf' else 'mixed'
+
 @app.route('/api/splitter/process', methods=['POST'])
 def splitter_process():
     col_a = request.form.get('col_a') 
     col_b = request.form.get('col_b') 
     col_c = request.form.get('col_c') 
     
-    file = request.files.get('file')
+    key = resolve_upload_key()
+    if not key: return jsonify({"success": False, "error": "文件已失效，请重新上传"}), 400
     sheet = request.form.get('sheet_name')
     days = int(request.form.get('days', 12))
     selected_cols = request.form.getlist('cols')[:10]
     int_units = request.form.getlist('int_units')
+    seed = request.form.get('seed', type=int)  # 可选: 传入相同种子可复现同一拆分结果
     
     try:
-        df = pd.read_excel(file, sheet_name=sheet)
+        df = _load_workbook(key, sheet)  # 缓存中的共享对象，下方过滤时才复制，不原地修改
         if col_a not in df.columns:
             return jsonify({"success": False, "error": f"未找到数量列: {col_a}"}), 400
 
         unit_col = next((c for c in df.columns if '单位' in str(c)), None)
         
-        df = df.dropna(subset=[col_a])
-        df[col_a] = pd.to_numeric(df[col_a], errors='coerce')
-        df = df[df[col_a] > 0]
-        
-        daily_rows = [[] for _ in range(days)]
-        
-        for _, row in df.iterrows():
-            unit = str(row.get(unit_col, '')) if unit_col else ""
-            orig_qty = row[col_a]
-            if pd.isna(orig_qty) or orig_qty == 0: continue
-            
-            if orig_qty <= 3: active = 1
-            elif orig_qty <= 10: active = random.randint(2, min(4, days))
-            else: active = random.randint(3, min(days, 10))
-            
-            splits = split_smart_algo(orig_qty, active, unit in int_units)
-            indices = sorted(random.sample(range(days), len(splits)))
-            
-            for i, day_idx in enumerate(indices):
-                new_qty = splits[i]
-                ratio = new_qty / orig_qty
-                
-                new_row = {}
-                for col in selected_cols:
-                    if col not in row: continue
-                    val = row[col]
-                    
-                    if col == col_a:
-                        new_row[col] = new_qty
-                    elif col == col_c and col_b and (col_b in row):
-                        try:
-                            price = float(row[col_b])
-                            new_row[col] = round(new_qty * price, 2)
-                        except:
-                            try: new_row[col] = round(float(val) * ratio, 2)
-                            except: new_row[col] = val
-                    elif isinstance(val, (int, float)):
-                        is_static = (col == col_b) or any(k in str(col).lower() for k in ['id', 'code', 'date', '日期', '单价', '价', '规格'])
-                        if not is_static:
-                            try: new_row[col] = round(float(val) * ratio, 2)
-                            except: new_row[col] = val
-                        else:
-                            new_row[col] = val
-                    else:
-                        new_row[col] = val
-                
-                daily_rows[day_idx].append(new_row)
+        # 数量列一次转换 + 一个布尔掩码完成过滤 (空值/非数字/非正数)，只产生一次拷贝
+        qty = pd.to_numeric(df[col_a], errors='coerce').to_numpy(dtype=np.float64)
+        mask = np.isfinite(qty) & (qty > 0)
+        df = df.loc[mask].copy()
+        qty_arr = qty[mask]
+        df[col_a] = qty_arr
         
+        # 逐行所需的数值一次性按列取出，活跃天数在 NumPy 中批量生成
+        n = len(df)
+        rng = np.random.default_rng(seed)
+        mid = rng.integers(2, max(min(4, days), 2), size=n, endpoint=True)
+        high = rng.integers(3, max(min(days, 10), 3), size=n, endpoint=True)
+        active_arr = np.minimum(np.select([qty_arr <= 3, qty_arr <= 10], [1, mid], default=high), days)
+        is_int_arr = df[unit_col].astype(str).isin(int_units).to_numpy() if unit_col else np.zeros(n, dtype=bool)
+        usable_cols = [c for c in selected_cols if c in df.columns]
+        has_price = bool(col_b) and col_b in df.columns and col_c in usable_cols and col_c != col_a
+        # 每行的随机天序一次性生成: 随机矩阵按行 argsort，取前 K 列即为不重复抽样；无效位置填 days 后排序，
+        # 每行前 counts 个即为按日期先后排列的拆分天
+        splits, counts = split_batch_algo(qty_arr, active_arr, is_int_arr, rng)
+        K = splits.shape[1]
+        valid = np.arange(K)[None, :] < counts[:, None]
+        day_order = rng.random((n, days), dtype=np.float32).argsort(axis=1)[:, :K]
+        day_order = np.sort(np.where(valid, day_order, days), axis=1)
+
+        # 长表输出: (来源行, 天, 拆分数量)，按行优先展开有效位置
+        src_idx = np.nonzero(valid)[0]
+        day_ids = day_order[valid]
+        split_qty = splits[valid]
+
+        # 各保留列按来源行整列取值，数值列乘以拆分比例后统一取整；每列的处理方式只判定一次
+        ratio = split_qty / qty_arr[src_idx]
+        col_kind = {c: split_col_kind(c, df[c], col_a, col_b, col_c, has_price) for c in usable_cols}
+        out_cols = {}
+        for col, kind in col_kind.items():
+            series = df[col]
+            if kind == 'qty':
+                out_cols[col] = split_qty
+            elif kind == 'amt':
+                # C 列: 优先 拆分数量 × 单价；单价无法转为数字时按比例缩放原 C 值，仍不行则保留原值
+                amount = np.round(pd.to_numeric(df[col_b], errors='coerce').to_numpy(dtype=np.float64)[src_idx] * split_qty, 2)
+                scaled = np.round(pd.to_numeric(series, errors='coerce').to_numpy(dtype=np.float64)[src_idx] * ratio, 2)
+                out_cols[col] = np.where(np.isnan(amount), np.where(np.isnan(scaled), series.to_numpy(dtype=object)[src_idx], scaled), amount)
+            elif kind == 'copy':
+                # 按 object 取值: 日期列得到 Timestamp；datetime64 数组之后再转 object 会变成纳秒整数
+                out_cols[col] = series.to_numpy(dtype=object)[src_idx]
+            elif kind == 'scale':
+                # 纯数值列: 按来源行取值后一次 np.multiply + np.round，无逐单元格 Python 操作
+                out_cols[col] = np.round(series.to_numpy(dtype=np.float64)[src_idx] * ratio, 2)
+            else:
+                # object 列可能混有文本，只缩放其中的数值单元格
+                vals = series.to_numpy(dtype=object)
+                is_num = np.fromiter((isinstance(v, (int, float)) and not isinstance(v, bool) for v in vals), dtype=bool, count=n)
+                nums = np.where(is_num, vals, np.nan).astype(np.float64)
+                out_cols[col] = np.where(is_num[src_idx], np.round(nums[src_idx] * ratio, 2), vals[src_idx])
+
         filename = f"拆分_{sheet}_{uuid.uuid4().hex[:8]}.xlsx"
-        path = os.path.join(app.config['RESULT_FOLDER'], filename)
-        
-        with pd.ExcelWriter(path, engine='openpyxl') as writer:
-            for i in range(days):
-                pd.DataFrame(daily_rows[i]).to_excel(writer, sheet_name=f'第{i+1}天', index=False)
         
-        return jsonify({"success": True, "filename": filename})
+        # 不再为每天构造 DataFrame: 按天稳定排序后，每张工作表就是所有列数组中的一个连续切片
+        order = np.argsort(day_ids, kind='stable')
+        bounds = np.searchsorted(day_ids[order], np.arange(days + 1))
+        cells = []
+        for arr in out_cols.values():
+            arr = arr[order].astype(object)
+            arr[pd.isna(arr)] = None  # 空值写为空白单元格
+            cells.append(arr)
+        sheets = [(f'第{i+1}天', zip(*(c[bounds[i]:bounds[i + 1]] for c in cells))) for i in range(days)]
+        return finish_result(lambda target: write_sheets_streaming(target, usable_cols, sheets), filename)
         
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
 @app.route('/api/splitter/download/<filename>')
-def splitter_download(filename):
-    return send_from_directory(app.config['RESULT_FOLDER'], filename, as_attachment=True)
+def splitter_download(filename): return send_result(filename)
 
 # --- 比对模块 ---
 @app.route('/tool/compare')
 def compare_ui(): return render_template('compare.html')
 
-def clean_name_algo(text): return re.sub(r'\*.*?\*', '', str(text)).strip() if not pd.isna(text) else ""
+_STAR_RE = re.compile(r'\*.*?\*')  # 模块级预编译
+
+# 不含 '*' 的名称无需进入正则引擎
+def clean_name_algo(text):
+    if pd.isna(text): return ""
+    s = str(text)
+    return (_STAR_RE.sub('', s) if '*' in s else s).strip()
+
+# 整列清洗名称: 发票名称大量重复，先 factorize 去重，只对唯一值做正则，再按编码映射回整列
+# (空值编码为 -1，正好取到末尾追加的 '')。直接返回 category，后续分组在整数编码上进行
+def clean_name_series(col):
+    codes, uniques = pd.factorize(col)
+    cleaned_codes, categories = pd.factorize(np.array([clean_name_algo(u) for u in uniques] + [''], dtype=object))
+    return pd.Series(pd.Categorical.from_codes(cleaned_codes[codes], categories=categories), index=col.index, name=col.name)
 
 @app.route('/api/compare/get_logs')
 def compare_get_logs():
-    global log_stream
-    # 【修复1】取出日志后立即清空，防止前端循环重复显示
-    logs = list(log_stream)
-    log_stream.clear()
+    # 【修复1】取出日志后立即清空，防止前端循环重复显示 (加锁保证快照与清空之间不丢日志)
+    with log_lock:
+        logs = list(log_stream)
+        log_stream.clear()
     return jsonify(logs)
 
+# 比对工具的列名统一为字符串: get_headers 返回的列名经前端原样提交，compare_prep 按同一规则匹配。
+# 数字表头 (calamine 读成 2024.0) 写作 "2024"，布尔/日期/时间表头按 str 转换，也避免 JSON 序列化失败
+def header_label(c):
+    if c is None or c == '': return c
+    if isinstance(c, float) and c.is_integer(): return str(int(c))
+    return str(c)
+
+def compare_header(row): return header_names([header_label(c) for c in row])
+
 @app.route('/api/compare/get_headers', methods=['POST'])
 def compare_get_headers():
     try: 
-        logger.info(f"正在读取表头: {request.files['file'].filename}")
-        return jsonify({"columns": pd.read_excel(request.files['file'], nrows=1).columns.tolist()})
+        file = request.files['file']
+        logger.info(f"正在读取表头: {file.filename}")
+        # 与 compare_prep 使用同一读取器 (calamine，与 read_excel 默认一致取第一个工作表) 和同一套列名规则
+        wb = CalamineWorkbook.from_filelike(file)
+        header = next(wb.get_sheet_by_index(0).iter_rows(), [])  # 与 compare_prep 相同，不跳过表头前的空行
+        wb.close()
+        return jsonify({"columns": compare_header(header)})
     except Exception as e: 
         logger.error(f"读取表头失败: {e}")
         return jsonify({"error": str(e)})
 
+# 在子进程中执行: calamine 逐行读取首个工作表，只收集映射的三列，不构造整表 DataFrame。
+# 聚合结果按 (上传文件, 列映射) 缓存，同一文件换另一侧文件或重跑时直接复用
+def compare_prep(key, name_col, qty_col, val_col):
+    cached = sheet_cache_path(key, ('compare', name_col, qty_col, val_col))
+    if os.path.exists(cached): return pd.read_pickle(cached)
+    with open(upload_path(key), 'rb') as f:  # 缓存文件统一以 .xlsx 命名，按内容识别格式
+        rows = CalamineWorkbook.from_filelike(f).get_sheet_by_index(0).iter_rows()
+    header = compare_header(next(rows, []))
+    ni, qi, vi = header.index(name_col), header.index(qty_col), header.index(val_col)
+    names, qty, val = [], [], []
+    for r in rows:
+        names.append(r[ni]); qty.append(r[qi]); val.append(r[vi])
+    # calamine 把数字单元格读成浮点: 整数值还原为 int，编码 10086 清洗后仍是 "10086" 而不是 "10086.0"，
+    # 与另一文件中以文本存储的同一编码保持一致
+    names = [int(x) if isinstance(x, float) and x.is_integer() else x for x in names]
+    # 文本格式的数字统一转为数值，聚合走 NumPy 快速路径
+    values = pd.DataFrame({'qty': qty, 'val': val}).apply(pd.to_numeric, errors='coerce')
+    # 清洗后的名称 (category) 直接作为分组键；observed=True 只保留出现过的键，sort=False 跳过排序
+    keys = clean_name_series(pd.Series(names, dtype=object)).rename('__k')
+    result = len(names), values.groupby(keys, observed=True, sort=False).sum().reset_index()
+    save_cache(result, cached)
+    return result
+
+# 全进程共用一个解析进程池，工作进程按需启动后常驻，不再每个请求重新创建。
+# 使用 spawn: 多线程服务器中 fork 会把其他线程持有的锁一并复制到子进程，可能死锁。
+# 工作进程异常退出 (如内存不足) 后进程池不可再用，reset=True 时换一个新的
+_compare_pool = None
+_COMPARE_POOL_LOCK = threading.Lock()
+
+def compare_pool(reset=False):
+    global _compare_pool
+    with _COMPARE_POOL_LOCK:
+        if _compare_pool is None or reset:
+            _compare_pool = ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context('spawn'))
+        return _compare_pool
+
 @app.route('/api/compare/process', methods=['POST'])
 def compare_process():
     try:
@@ -311,16 +596,19 @@ def compare_process():
         logger.info(f"🚀 开始任务: 进项[{f_in.filename}] vs 销项[{f_out.filename}]")
         logger.info(f"🔗 映射关系: 进项[{m['map_in_name']}] <--> 销项[{m['map_out_name']}]")
 
-        df_in, df_out = pd.read_excel(f_in), pd.read_excel(f_out)
-        logger.info(f"📄 文件加载完成: 进项 {len(df_in)} 行, 销项 {len(df_out)} 行")
-
-        # 数据清洗
-        df_in['__k'] = df_in[m['map_in_name']].apply(clean_name_algo)
-        df_out['__k'] = df_out[m['map_out_name']].apply(clean_name_algo)
-        
-        logger.info("🧹 正在进行数据清洗与聚合...")
-        agg_in = df_in.groupby('__k')[[m['map_in_qty'], m['map_in_val']]].sum().reset_index()
-        agg_out = df_out.groupby('__k')[[m['map_out_qty'], m['map_out_val']]].sum().reset_index()
+        # 进项/销项两条 "读取 → 清洗 → 聚合" 流水线互不依赖，分别在两个进程中并行执行 (逐行解析受 GIL 限制)
+        logger.info("🧹 正在加载文件并进行数据清洗与聚合...")
+        key_in, key_out = save_upload(f_in), save_upload(f_out)
+        pool = compare_pool()
+        try:
+            fut_in = pool.submit(compare_prep, key_in, m['map_in_name'], m['map_in_qty'], m['map_in_val'])
+            fut_out = pool.submit(compare_prep, key_out, m['map_out_name'], m['map_out_qty'], m['map_out_val'])
+            (n_in, agg_in), (n_out, agg_out) = fut_in.result(), fut_out.result()
+        except BrokenProcessPool:
+            compare_pool(reset=True)
+            raise
+        logger.info(f"📄 进项文件加载完成: {n_in} 行")
+        logger.info(f"📄 销项文件加载完成: {n_out} 行")
         
         # 【修复2】动态设置 Key 列名，保留用户选择的原表头名称
         # 使用“进项名称列”作为最终结果的 Key 列名
@@ -329,24 +617,28 @@ def compare_process():
         agg_in.columns = [key_col_name, '进项_数量', '进项_金额']
         agg_out.columns = [key_col_name, '销项_数量', '销项_金额']
         
+        # 两侧键统一为同一组 (按名称排序的) category，拼接后一次分组求和即可得到外连接结果
+        categories = union_categoricals([agg_in[key_col_name], agg_out[key_col_name]], ignore_order=True).categories.sort_values()
+        agg_in[key_col_name] = agg_in[key_col_name].cat.set_categories(categories)
+        agg_out[key_col_name] = agg_out[key_col_name].cat.set_categories(categories)
+
         logger.info("🔄 正在执行差异比对...")
-        res = pd.merge(agg_in, agg_out, on=key_col_name, how='outer').fillna(0)
+        # 单侧缺失的列在拼接后为 NaN，sum 按 0 计 (等同 outer merge + fillna(0))
+        res = pd.concat([agg_in, agg_out], ignore_index=True).groupby(key_col_name, observed=True).sum().reset_index()
         
         res['差异_数量'] = res['销项_数量'] - res['进项_数量']
         res['差异_金额'] = res['销项_金额'] - res['进项_金额']
         
         fname = f"result_{uuid.uuid4().hex}.xlsx"
-        res.to_excel(os.path.join(app.config['RESULT_FOLDER'], fname), index=False)
-        
-        logger.info(f"✅ 比对成功! 结果已生成: {fname}")
-        return jsonify({"success": True, "filename": fname})
+        logger.info(f"✅ 比对成功! 正在生成结果: {fname}")
+        # 安装 xlsxwriter 后 pandas 默认改用它写 xlsx，这里显式保留原来的 openpyxl 写出方式
+        return finish_result(lambda target: res.to_excel(target, index=False, engine='openpyxl'), fname)
     except Exception as e: 
         logger.error(f"❌ 处理失败: {str(e)}")
         return jsonify({"success": False, "message": str(e)})
 
 @app.route('/api/compare/download/<filename>')
-def compare_download(filename):
-    return send_from_directory(app.config['RESULT_FOLDER'], filename, as_attachment=True)
+def compare_download(filename): return send_result(filename)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
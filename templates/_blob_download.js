@@ -0,0 +1,8 @@
+// 把 ?stream=1 直接返回的结果文件挂到下载链接上 (拆分/比对页面共用)
+function setBlobDownload(link, resp, blob) {
+    const cd = resp.headers.get('Content-Disposition') || '';
+    const m = cd.match(/filename\*=UTF-8''([^;]+)/i) || cd.match(/filename="?([^";]+)"?/i);
+    if (link.href.startsWith('blob:')) URL.revokeObjectURL(link.href);
+    link.href = URL.createObjectURL(blob);
+    link.download = m ? decodeURIComponent(m[1]) : 'result.xlsx';
+}